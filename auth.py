@@ -1,8 +1,11 @@
 # auth.py
 import os # <--- IMPORTANTE: Importar os
+import time
 from datetime import datetime, timedelta
 from typing import Optional
-from jose import JWTError, jwt
+import jwt
+from jwt import InvalidTokenError
+from cachetools import TTLCache
 from passlib.context import CryptContext
 
 # LEER DESDE LA VARIABLE DE ENTORNO
@@ -28,4 +31,22 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
         expire = datetime.utcnow() + timedelta(minutes=15)
     to_encode.update({"exp": expire})
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
-    return encoded_jwt
\ No newline at end of file
+    return encoded_jwt
+
+# Tokens ya verificados: evita repetir la verificación HMAC en cada petición
+_decoded_tokens: TTLCache = TTLCache(maxsize=10_000, ttl=30)
+
+def decode_access_token(token: str) -> dict:
+    """
+    Decodifica y valida un token JWT. Lanza InvalidTokenError si no es válido.
+    """
+    payload = _decoded_tokens.get(token)
+    if payload is not None:
+        # La caché no sabe de expiraciones: volver a revisar 'exp'
+        if payload["exp"] <= time.time():
+            _decoded_tokens.pop(token, None)
+            raise jwt.ExpiredSignatureError("Signature has expired")
+        return payload
+    payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+    _decoded_tokens[token] = payload
+    return payload
\ No newline at end of file
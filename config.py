@@ -1,14 +1,12 @@
 # config.py
 import os
+from functools import lru_cache
 from dotenv import load_dotenv
 
-# Esto carga las variables del archivo .env
-load_dotenv()
+@lru_cache(maxsize=1)
+def _load_mapbox_token():
+    # Esto carga las variables del archivo .env (una sola vez por proceso)
+    load_dotenv()
+    return os.getenv("MAPBOX_ACCESS_TOKEN")
 
-# Ahora, getenv() buscará la variable que acabamos de cargar
-MAPBOX_ACCESS_TOKEN = os.getenv("MAPBOX_ACCESS_TOKEN")
-
-# Verificación de seguridad
-if not MAPBOX_ACCESS_TOKEN:
-    print("¡ERROR! MAPBOX_ACCESS_TOKEN no encontrado en el archivo .env")
-    # En un sistema real, aquí detendríamos la aplicación
\ No newline at end of file
+MAPBOX_ACCESS_TOKEN = _load_mapbox_token()
\ No newline at end of file
@@ -1,19 +1,73 @@
 # database.py
+import os
 from sqlmodel import SQLModel, create_engine, Session
+from sqlalchemy import event
+from sqlalchemy.pool import QueuePool
 
 # 1. Define el nombre de tu archivo de base de datos
 DATABASE_FILE = "product.db"
 sqlite_url = f"sqlite:///{DATABASE_FILE}"
+# URI de solo lectura (SQLite abre el archivo con mode=ro)
+sqlite_ro_url = f"sqlite:///file:{DATABASE_FILE}?mode=ro&uri=true"
+# El log de SQL solo se activa a pedido (SQL_ECHO=1), es caro en cada consulta
+SQL_ECHO = os.getenv("SQL_ECHO") == "1"
 
-# 2. Crea el "motor" de la base de datos.
-engine = create_engine(sqlite_url, echo=True, 
-                       connect_args={"check_same_thread": False})
+# 2. Crea los "motores" de la base de datos.
+# SQLite solo admite un escritor a la vez: el motor de escritura tiene una
+# única conexión (los escritores hacen cola aquí en vez de chocar con
+# SQLITE_BUSY) y el de lectura escala con el número de CPUs.
+engine_rw = create_engine(sqlite_url, echo=SQL_ECHO,
+                          poolclass=QueuePool, pool_size=1, max_overflow=0,
+                          connect_args={"check_same_thread": False})
+
+engine_ro = create_engine(sqlite_ro_url, echo=SQL_ECHO,
+                          poolclass=QueuePool, pool_size=os.cpu_count() or 1,
+                          connect_args={"check_same_thread": False})
+
+# 3. Ajustes de SQLite para cada conexión nueva
+# WAL permite lectores concurrentes con un escritor, y synchronous=NORMAL
+# evita un fsync por cada commit. journal_mode es persistente en el archivo,
+# así que solo lo fija el motor de escritura.
+SQLITE_PRAGMAS = (
+    "synchronous=NORMAL",
+    "temp_store=MEMORY",
+    "mmap_size=268435456",
+    "cache_size=-65536",
+    "busy_timeout=5000",
+    "foreign_keys=ON",
+)
+
+def _apply_pragmas(dbapi_connection, pragmas):
+    cursor = dbapi_connection.cursor()
+    for pragma in pragmas:
+        cursor.execute(f"PRAGMA {pragma}")
+    cursor.close()
+
+@event.listens_for(engine_rw, "connect")
+def _set_sqlite_pragmas_rw(dbapi_connection, connection_record):
+    _apply_pragmas(dbapi_connection, ("journal_mode=WAL",) + SQLITE_PRAGMAS)
+    # Desactivamos el BEGIN implícito de pysqlite para emitir el nuestro
+    dbapi_connection.isolation_level = None
+
+@event.listens_for(engine_rw, "begin")
+def _begin_immediate(conn):
+    # BEGIN IMMEDIATE toma el candado de escritura al inicio de la
+    # transacción, así no falla a mitad de camino con SQLITE_BUSY.
+    conn.exec_driver_sql("BEGIN IMMEDIATE")
+
+@event.listens_for(engine_ro, "connect")
+def _set_sqlite_pragmas_ro(dbapi_connection, connection_record):
+    _apply_pragmas(dbapi_connection, SQLITE_PRAGMAS)
 
 def create_db_and_tables():
     """
     Función para inicializar la base de datos y crear las tablas.
     """
-    SQLModel.metadata.create_all(engine)
+    SQLModel.metadata.create_all(engine_rw)
+    # create_all no agrega índices nuevos a tablas que ya existen
+    for table in SQLModel.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(engine_rw, checkfirst=True)
 
 # ---------------------------------------------------------
 # NUEVA SECCIÓN: Función para obtener una sesión de BD
@@ -21,7 +75,17 @@ def create_db_and_tables():
 def get_session():
     """
     Generador de dependencia que proporciona una sesión de base de datos
-    a los endpoints de la API.
+    (solo lectura) a los endpoints de la API.
+    """
+    with Session(engine_ro) as session:
+        yield session
+
+def get_write_session():
+    """
+    Igual que get_session, pero sobre el motor de escritura. Usar en los
+    endpoints que hacen INSERT/UPDATE/DELETE.
+    Los objetos no se expiran al hacer commit: lo que se acaba de escribir
+    se devuelve tal cual, sin otro SELECT.
     """
-    with Session(engine) as session:
+    with Session(engine_rw, expire_on_commit=False) as session:
         yield session
\ No newline at end of file
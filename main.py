@@ -2,40 +2,66 @@
 from fastapi import FastAPI, Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
 from contextlib import asynccontextmanager
+import os
 from typing import List, Optional
+from threading import Lock
 from datetime import time, timedelta
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, StreamingResponse
+from starlette.concurrency import run_in_threadpool
 
-from database import create_db_and_tables, get_session
+from database import create_db_and_tables, get_session, get_write_session, engine_ro
 # Importamos los modelos, incluyendo User y Token
 from models import (
-    Parada, ParadaUpdate, ParadaRead,
-    Ruta, RutaCreate, RutaRead, RutaReadConParadas,
+    Parada, ParadaCreate, ParadaUpdate, ParadaRead,
+    Ruta, RutaCreate, RutaRead, RutaReadConParadas, RutaParada,
     User, UserCreate, UserRead, Token
 )
 from sqlmodel import Session, select
+from sqlalchemy import func, insert
+from sqlalchemy.orm import selectinload
 from pydantic import BaseModel 
+from cachetools import TTLCache
+import orjson
 
 # Importamos la lógica de seguridad y el solver
 from auth import (
     get_password_hash, verify_password, create_access_token, 
-    ACCESS_TOKEN_EXPIRE_MINUTES, SECRET_KEY, ALGORITHM
+    decode_access_token, InvalidTokenError, ACCESS_TOKEN_EXPIRE_MINUTES
 )
-from jose import JWTError, jwt
-from solver import solve_vrp, NoSolutionError
+from solver import solve_vrp, NoSolutionError, ParadaSolver, close_mapbox_client
+from matrix_cache import get_cached_matrix
+from config import MAPBOX_ACCESS_TOKEN
 
 # --- Configuración de Seguridad ---
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 
+# Usuarios ya buscados por id, para no consultar la BD en cada petición
+_users_by_id: TTLCache = TTLCache(maxsize=10_000, ttl=60)
+
 # --- Lifespan ---
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     print("El servidor está iniciando...")
-    create_db_and_tables()
-    print("Base de datos y tablas creadas.")
+    # Verificación de seguridad: sin token no se puede calcular ninguna ruta
+    if not MAPBOX_ACCESS_TOKEN:
+        raise RuntimeError("¡ERROR! MAPBOX_ACCESS_TOKEN no encontrado en el archivo .env")
+    # El esquema lo gestiona Alembic (alembic upgrade head); crear las tablas
+    # al arrancar solo si se pide, para no repetir DDL en cada worker
+    if os.getenv("INIT_DB") == "1":
+        create_db_and_tables()
+        print("Base de datos y tablas creadas.")
+    # Ejecutar una vez las consultas más usadas para que SQLAlchemy las
+    # compile y guarde en caché antes de la primera petición real
+    with Session(engine_ro) as session:
+        session.exec(select(Parada).where(Parada.user_id == 0)).all()
+        session.exec(
+            select(Ruta).where(Ruta.user_id == 0).options(selectinload(Ruta.paradas))
+        ).all()
+        session.exec(select(User).where(User.email == "")).first()
     yield
     print("El servidor se está apagando...")
+    await close_mapbox_client()
 
 app = FastAPI(
     title="Sistema de Logística SaaS v3.0",
@@ -55,25 +81,37 @@ app.add_middleware(
 # ---------------------------------------------------------
 # DEPENDENCIA DE SEGURIDAD: Obtener Usuario Actual
 # ---------------------------------------------------------
-async def get_current_user(token: str = Depends(oauth2_scheme), session: Session = Depends(get_session)):
-    credentials_exception = HTTPException(
-        status_code=status.HTTP_401_UNAUTHORIZED,
-        detail="No se pudieron validar las credenciales",
-        headers={"WWW-Authenticate": "Bearer"},
-    )
+credentials_exception = HTTPException(
+    status_code=status.HTTP_401_UNAUTHORIZED,
+    detail="No se pudieron validar las credenciales",
+    headers={"WWW-Authenticate": "Bearer"},
+)
+
+async def get_current_user_id(token: str = Depends(oauth2_scheme)) -> int:
+    """
+    Devuelve el id del usuario del token sin consultar la BD (el id viaja
+    en el claim 'sub'). Es lo único que necesitan casi todos los endpoints.
+    """
     try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        email: str = payload.get("sub")
-        if email is None:
-            raise credentials_exception
-    except JWTError:
+        payload = decode_access_token(token)
+        return int(payload["sub"])
+    except (InvalidTokenError, KeyError, ValueError):
         raise credentials_exception
-        
+
+async def get_current_user(
+    user_id: int = Depends(get_current_user_id),
+    session: Session = Depends(get_session)
+):
+    """Igual que get_current_user_id, pero trae la fila completa del usuario."""
+    user = _users_by_id.get(user_id)
+    if user is not None:
+        return user
+
     # Buscar el usuario en la BD
-    statement = select(User).where(User.email == email)
-    user = session.exec(statement).first()
+    user = session.get(User, user_id)
     if user is None:
         raise credentials_exception
+    _users_by_id[user_id] = user
     return user
 
 # ---------------------------------------------------------
@@ -81,8 +119,13 @@ async def get_current_user(token: str = Depends(oauth2_scheme), session: Session
 # ---------------------------------------------------------
 
 @app.post("/register", response_model=UserRead)
-def register_user(*, session: Session = Depends(get_session), user_in: UserCreate):
+def register_user(*, session: Session = Depends(get_write_session), user_in: UserCreate):
     """Crea un nuevo usuario en el sistema."""
+    # Endpoint sync: FastAPI lo corre en el threadpool, así bcrypt (lento) y
+    # la BD no bloquean el event loop. Se encripta antes de tocar la BD para
+    # no retener el candado de escritura mientras tanto
+    hashed_pwd = get_password_hash(user_in.password)
+
     # Verificar si el email ya existe
     statement = select(User).where(User.email == user_in.email)
     existing_user = session.exec(statement).first()
@@ -90,7 +133,6 @@ def register_user(*, session: Session = Depends(get_session), user_in: UserCreat
         raise HTTPException(status_code=400, detail="El email ya está registrado")
     
     # Crear usuario con contraseña encriptada
-    hashed_pwd = get_password_hash(user_in.password)
     user = User(
         email=user_in.email, 
         password_hash=hashed_pwd,
@@ -121,7 +163,7 @@ def login_for_access_token(
     # Crear token
     access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
     access_token = create_access_token(
-        data={"sub": user.email}, expires_delta=access_token_expires
+        data={"sub": str(user.id), "email": user.email}, expires_delta=access_token_expires
     )
     return {"access_token": access_token, "token_type": "bearer"}
 
@@ -139,46 +181,63 @@ async def read_index():
 @app.post("/paradas/", response_model=Parada)
 def create_parada(
     *, 
-    session: Session = Depends(get_session), 
-    parada: Parada,
-    current_user: User = Depends(get_current_user) # <-- PROTECCIÓN
+    session: Session = Depends(get_write_session), 
+    parada: ParadaCreate,
+    current_user_id: int = Depends(get_current_user_id) # <-- PROTECCIÓN
 ):
-    # Asignar la parada al usuario actual
-    parada.user_id = current_user.id
-    
-    # Convertir horas
-    if isinstance(parada.ventana_inicio, str):
-        parada.ventana_inicio = time.fromisoformat(parada.ventana_inicio)
-    if isinstance(parada.ventana_fin, str):
-        parada.ventana_fin = time.fromisoformat(parada.ventana_fin)
-        
-    session.add(parada)
+    # INSERT ... RETURNING: una sola sentencia en vez de INSERT + SELECT
+    # (la parada queda asignada al usuario actual)
+    statement = insert(Parada).values(
+        **parada.model_dump(), user_id=current_user_id
+    ).returning(Parada)
+    db_parada = session.execute(statement).scalar_one()
     session.commit()
-    session.refresh(parada)
-    return parada
+    return db_parada
 
 @app.get("/paradas/", response_model=List[Parada])
 def read_paradas(
     *, 
     session: Session = Depends(get_session),
-    current_user: User = Depends(get_current_user) # <-- PROTECCIÓN
+    current_user_id: int = Depends(get_current_user_id) # <-- PROTECCIÓN
 ):
     # ¡MAGIA! Solo devolvemos las paradas de ESTE usuario
-    statement = select(Parada).where(Parada.user_id == current_user.id)
+    statement = select(Parada).where(Parada.user_id == current_user_id)
     paradas = session.exec(statement).all()
     return paradas
 
+@app.get("/paradas/stream")
+def stream_paradas(
+    *,
+    current_user_id: int = Depends(get_current_user_id)
+):
+    """
+    Igual que GET /paradas/, pero en NDJSON (una parada por línea) y leyendo
+    de a bloques: la memoria no crece con el número de paradas.
+    """
+    def generate():
+        # Sesión propia: la de Depends se cierra antes de enviar el cuerpo
+        with Session(engine_ro) as session:
+            statement = (
+                select(Parada)
+                .where(Parada.user_id == current_user_id)
+                .execution_options(yield_per=256)
+            )
+            for parada in session.exec(statement):
+                yield orjson.dumps(ParadaRead.model_validate(parada).model_dump()) + b"\n"
+
+    return StreamingResponse(generate(), media_type="application/x-ndjson")
+
 @app.patch("/paradas/{parada_id}", response_model=Parada)
 def update_parada(
     *,
-    session: Session = Depends(get_session),
+    session: Session = Depends(get_write_session),
     parada_id: int,
     parada_update: ParadaUpdate,
-    current_user: User = Depends(get_current_user)
+    current_user_id: int = Depends(get_current_user_id)
 ):
     # Buscar parada Y verificar que sea del usuario
     db_parada = session.get(Parada, parada_id)
-    if not db_parada or db_parada.user_id != current_user.id:
+    if not db_parada or db_parada.user_id != current_user_id:
         raise HTTPException(status_code=404, detail="Parada no encontrada")
     
     update_data = parada_update.model_dump(exclude_unset=True)
@@ -192,12 +251,12 @@ def update_parada(
 @app.delete("/paradas/{parada_id}")
 def delete_parada(
     *,
-    session: Session = Depends(get_session),
+    session: Session = Depends(get_write_session),
     parada_id: int,
-    current_user: User = Depends(get_current_user)
+    current_user_id: int = Depends(get_current_user_id)
 ):
     parada = session.get(Parada, parada_id)
-    if not parada or parada.user_id != current_user.id:
+    if not parada or parada.user_id != current_user_id:
         raise HTTPException(status_code=404, detail="Parada no encontrada")
     session.delete(parada)
     session.commit()
@@ -208,37 +267,55 @@ def delete_parada(
 @app.post("/rutas/", response_model=RutaReadConParadas)
 def create_ruta(
     *,
-    session: Session = Depends(get_session),
+    session: Session = Depends(get_write_session),
     ruta_in: RutaCreate,
-    current_user: User = Depends(get_current_user)
+    current_user_id: int = Depends(get_current_user_id)
 ):
     # Verificar que las paradas pertenezcan al usuario
-    statement = select(Parada).where(
+    statement = select(func.count(Parada.id)).where(
         Parada.id.in_(ruta_in.parada_ids),
-        Parada.user_id == current_user.id
+        Parada.user_id == current_user_id
     )
-    paradas = session.exec(statement).all()
+    total = session.exec(statement).one()
     
-    if len(paradas) != len(ruta_in.parada_ids):
+    if total != len(ruta_in.parada_ids):
         raise HTTPException(status_code=404, detail="Una o más paradas no válidas")
         
-    db_ruta = Ruta(nombre=ruta_in.nombre, paradas=paradas, user_id=current_user.id)
+    db_ruta = Ruta(nombre=ruta_in.nombre, user_id=current_user_id)
     session.add(db_ruta)
+    session.flush()
+
+    # Enlaces ruta-parada en un solo INSERT con varios parámetros (executemany).
+    # Con la lista vacía no hay nada que insertar (sería un DEFAULT VALUES)
+    if ruta_in.parada_ids:
+        session.execute(
+            insert(RutaParada),
+            [{"ruta_id": db_ruta.id, "parada_id": pid} for pid in ruta_in.parada_ids]
+        )
     session.commit()
-    session.refresh(db_ruta)
     
-    # Recargar para mostrar
-    ruta_guardada = session.get(Ruta, db_ruta.id)
+    # Recargar para mostrar (con las paradas en una sola consulta)
+    statement = (
+        select(Ruta)
+        .options(selectinload(Ruta.paradas))
+        .where(Ruta.id == db_ruta.id)
+        .execution_options(populate_existing=True)
+    )
+    ruta_guardada = session.exec(statement).one()
     return ruta_guardada
 
 @app.get("/rutas/", response_model=List[RutaReadConParadas])
 def read_rutas(
     *,
     session: Session = Depends(get_session),
-    current_user: User = Depends(get_current_user)
+    current_user_id: int = Depends(get_current_user_id)
 ):
-    # Solo rutas del usuario
-    statement = select(Ruta).where(Ruta.user_id == current_user.id)
+    # Solo rutas del usuario (selectinload evita una consulta por ruta)
+    statement = (
+        select(Ruta)
+        .where(Ruta.user_id == current_user_id)
+        .options(selectinload(Ruta.paradas))
+    )
     rutas = session.exec(statement).all()
     return rutas
 
@@ -260,47 +337,93 @@ class OptimizeResponse(BaseModel):
     total_duration_seconds: int
     total_duration_str: str
 
+# --- Caché de soluciones del VRP ---
+# Clave: (usuario, inicio redondeado, filas de las paradas tal como están en
+# la BD). Si una parada cambia en cualquier worker, la próxima consulta trae
+# otra fila y la clave deja de coincidir: nunca se sirve una solución vieja.
+VRP_CACHE: TTLCache = TTLCache(maxsize=1024, ttl=300)
+_vrp_lock = Lock()
+
+def clave_cache_vrp(user_id: int, request: OptimizeRequest, paradas: List[ParadaSolver]) -> tuple:
+    return (
+        user_id,
+        round(request.start_lat, 5), round(request.start_lng, 5),
+        tuple(paradas)
+    )
+
+def cargar_paradas_solver(session: Session, user_id: int, parada_ids: List[int]) -> List[ParadaSolver]:
+    """
+    Trae las paradas a optimizar como ParadaSolver (ordenadas por id).
+    Lanza 404 si alguna no existe o no es del usuario.
+    """
+    # Solo optimizar paradas que pertenezcan al usuario
+    filtro = (
+        Parada.id.in_(parada_ids),
+        Parada.user_id == user_id
+    )
+    total = session.exec(select(func.count(Parada.id)).where(*filtro)).one()
+    
+    if total != len(parada_ids):
+        raise HTTPException(status_code=404, detail="Una o más paradas no encontradas o no te pertenecen")
+
+    # Traer solo las columnas que usan el solver y la respuesta
+    # (en el mismo orden que los campos de ParadaSolver). Ordenadas por id
+    # para que la clave de la caché de matrices sea estable.
+    statement = select(
+        Parada.id, Parada.nombre, Parada.lat, Parada.lng,
+        Parada.ventana_inicio, Parada.ventana_fin, Parada.tiempo_servicio_min
+    ).where(*filtro).order_by(Parada.id)
+    paradas_destino = [ParadaSolver(*row) for row in session.exec(statement)]
+
+    return paradas_destino
+
 @app.post("/api/v2/optimizar-ruta", response_model=OptimizeResponse)
-def optimizar_ruta(
+async def optimizar_ruta(
     *,
     session: Session = Depends(get_session),
     request: OptimizeRequest,
-    current_user: User = Depends(get_current_user) # También protegido
+    current_user_id: int = Depends(get_current_user_id) # También protegido
 ):
-    parada_inicio = Parada(
+    parada_inicio = ParadaSolver(
         id=0, nombre="Inicio (Usuario)",
         lat=request.start_lat, lng=request.start_lng,
         ventana_inicio=time(0, 1), ventana_fin=time(23, 59), tiempo_servicio_min=0
     )
     
-    # Solo optimizar paradas que pertenezcan al usuario
-    statement = select(Parada).where(
-        Parada.id.in_(request.parada_ids),
-        Parada.user_id == current_user.id
+    # Consultas sync: en el threadpool, fuera del event loop
+    paradas_destino = await run_in_threadpool(
+        cargar_paradas_solver, session, current_user_id, request.parada_ids
     )
-    paradas_destino = session.exec(statement).all()
-    
-    if len(paradas_destino) != len(request.parada_ids):
-        raise HTTPException(status_code=404, detail="Una o más paradas no encontradas o no te pertenecen")
+
+    clave = clave_cache_vrp(current_user_id, request, paradas_destino)
+    with _vrp_lock:
+        cacheada = VRP_CACHE.get(clave)
+    if cacheada is not None:
+        return cacheada
 
     paradas_totales = [parada_inicio] + paradas_destino
     
     try:
-        ruta_data = solve_vrp(paradas_totales) 
+        # La matriz (con caché) se obtiene mientras se arma el modelo
+        ruta_data = await solve_vrp(paradas_totales, fetch_matrix=get_cached_matrix)
         stops_dto = []
         for stop in ruta_data["stops"]:
             stops_dto.append(RouteStop(
-                parada=ParadaRead.model_validate(stop["parada"]),
+                # Datos ya validados al leerlos de la BD: construir sin revalidar
+                parada=ParadaRead.model_construct(**stop["parada"]._asdict()),
                 arrival_time=stop["arrival_time"],
                 departure_time=stop["departure_time"],
                 travel_time_to_stop=stop["travel_time_to_stop"]
             ))
 
-        return OptimizeResponse(
+        respuesta = OptimizeResponse(
             stops=stops_dto,
             total_duration_seconds=ruta_data["total_duration_seconds"],
             total_duration_str=ruta_data["total_duration_str"]
         )
+        with _vrp_lock:
+            VRP_CACHE[clave] = respuesta
+        return respuesta
     except NoSolutionError as e:
         raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
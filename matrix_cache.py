@@ -0,0 +1,33 @@
+# matrix_cache.py
+from threading import Lock
+from typing import List
+from cachetools import TTLCache
+
+from solver import ParadaSolver, get_real_time_matrix
+
+# -----------------------------------------------------------------
+# Caché de matrices de tiempos de viaje (Mapbox)
+# -----------------------------------------------------------------
+# La clave es la secuencia ordenada de (id, lat, lng) redondeados: si una
+# parada cambia de lugar, la clave cambia sola y no hace falta invalidar.
+# Va ordenada (no un frozenset) porque la fila i de la matriz corresponde a
+# la parada i de la lista.
+MATRIX: TTLCache = TTLCache(maxsize=256, ttl=3600)
+_matrix_lock = Lock()
+
+def clave_matriz(paradas: List[ParadaSolver]) -> tuple:
+    return tuple((p.id, round(p.lat, 5), round(p.lng, 5)) for p in paradas)
+
+async def get_cached_matrix(paradas: List[ParadaSolver]) -> List[List[int]]:
+    """
+    Devuelve la matriz de tiempos para estas paradas, llamando a Mapbox solo
+    si no está en la caché.
+    """
+    clave = clave_matriz(paradas)
+    with _matrix_lock:
+        matriz = MATRIX.get(clave)
+    if matriz is None:
+        matriz = await get_real_time_matrix(paradas)
+        with _matrix_lock:
+            MATRIX[clave] = matriz
+    return matriz
\ No newline at end of file
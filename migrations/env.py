@@ -0,0 +1,45 @@
+# migrations/env.py
+from logging.config import fileConfig
+
+from alembic import context
+from sqlmodel import SQLModel
+
+import models  # noqa: F401  (registra las tablas en SQLModel.metadata)
+from database import engine_rw, sqlite_url
+
+config = context.config
+if config.config_file_name is not None:
+    fileConfig(config.config_file_name)
+
+target_metadata = SQLModel.metadata
+
+
+def run_migrations_offline():
+    """Genera el SQL de las migraciones sin conectarse a la BD."""
+    context.configure(
+        url=sqlite_url,
+        target_metadata=target_metadata,
+        literal_binds=True,
+        render_as_batch=True,
+    )
+    with context.begin_transaction():
+        context.run_migrations()
+
+
+def run_migrations_online():
+    """Aplica las migraciones usando el motor de escritura de la app."""
+    with engine_rw.connect() as connection:
+        # render_as_batch: SQLite no soporta la mayoría de ALTER TABLE
+        context.configure(
+            connection=connection,
+            target_metadata=target_metadata,
+            render_as_batch=True,
+        )
+        with context.begin_transaction():
+            context.run_migrations()
+
+
+if context.is_offline_mode():
+    run_migrations_offline()
+else:
+    run_migrations_online()
@@ -0,0 +1,70 @@
+"""Esquema inicial (usuarios, rutas, paradas)
+
+Revision ID: 0001
+Revises:
+Create Date: 2026-10-15
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = "0001"
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        "user",
+        sa.Column("id", sa.Integer(), nullable=False),
+        sa.Column("email", sa.String(), nullable=False),
+        sa.Column("password_hash", sa.String(), nullable=False),
+        sa.Column("nombre_completo", sa.String(), nullable=True),
+        sa.PrimaryKeyConstraint("id"),
+    )
+    op.create_index("ix_user_email", "user", ["email"], unique=True)
+
+    op.create_table(
+        "ruta",
+        sa.Column("nombre", sa.String(), nullable=False),
+        sa.Column("id", sa.Integer(), nullable=False),
+        sa.Column("user_id", sa.Integer(), nullable=True),
+        sa.ForeignKeyConstraint(["user_id"], ["user.id"]),
+        sa.PrimaryKeyConstraint("id"),
+    )
+    op.create_index("ix_ruta_nombre", "ruta", ["nombre"])
+
+    op.create_table(
+        "parada",
+        sa.Column("nombre", sa.String(), nullable=False),
+        sa.Column("lat", sa.Float(), nullable=False),
+        sa.Column("lng", sa.Float(), nullable=False),
+        sa.Column("ventana_inicio", sa.Time(), nullable=False),
+        sa.Column("ventana_fin", sa.Time(), nullable=False),
+        sa.Column("tiempo_servicio_min", sa.Integer(), nullable=False),
+        sa.Column("id", sa.Integer(), nullable=False),
+        sa.Column("user_id", sa.Integer(), nullable=True),
+        sa.ForeignKeyConstraint(["user_id"], ["user.id"]),
+        sa.PrimaryKeyConstraint("id"),
+    )
+    op.create_index("ix_parada_nombre", "parada", ["nombre"])
+
+    op.create_table(
+        "rutaparada",
+        sa.Column("ruta_id", sa.Integer(), nullable=False),
+        sa.Column("parada_id", sa.Integer(), nullable=False),
+        sa.ForeignKeyConstraint(["ruta_id"], ["ruta.id"]),
+        sa.ForeignKeyConstraint(["parada_id"], ["parada.id"]),
+        sa.PrimaryKeyConstraint("ruta_id", "parada_id"),
+    )
+
+
+def downgrade():
+    op.drop_table("rutaparada")
+    op.drop_index("ix_parada_nombre", table_name="parada")
+    op.drop_table("parada")
+    op.drop_index("ix_ruta_nombre", table_name="ruta")
+    op.drop_table("ruta")
+    op.drop_index("ix_user_email", table_name="user")
+    op.drop_table("user")
@@ -0,0 +1,27 @@
+"""Índices por usuario en paradas y rutas; quitar índices de nombre
+
+Revision ID: 0002
+Revises: 0001
+Create Date: 2026-10-15
+"""
+from alembic import op
+
+
+revision = "0002"
+down_revision = "0001"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.drop_index("ix_parada_nombre", table_name="parada", if_exists=True)
+    op.drop_index("ix_ruta_nombre", table_name="ruta", if_exists=True)
+    op.create_index("ix_parada_user_id_id", "parada", ["user_id", "id"], if_not_exists=True)
+    op.create_index("ix_ruta_user_id", "ruta", ["user_id"], if_not_exists=True)
+
+
+def downgrade():
+    op.drop_index("ix_ruta_user_id", table_name="ruta")
+    op.drop_index("ix_parada_user_id_id", table_name="parada")
+    op.create_index("ix_ruta_nombre", "ruta", ["nombre"])
+    op.create_index("ix_parada_nombre", "parada", ["nombre"])
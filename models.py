@@ -1,5 +1,7 @@
 # models.py
 from sqlmodel import SQLModel, Field, Relationship
+from sqlalchemy import Index
+from pydantic import field_validator
 from typing import Optional, List
 from datetime import time
 
@@ -28,16 +30,22 @@ class RutaParada(SQLModel, table=True):
 # Modelos Base
 # -----------------------------------------------------------------
 class RutaBase(SQLModel):
-    nombre: str = Field(index=True)
+    nombre: str
 
 class ParadaBase(SQLModel):
-    nombre: str = Field(index=True)
+    nombre: str
     lat: float
     lng: float
     ventana_inicio: time = Field(default=time(8, 0))
     ventana_fin: time = Field(default=time(18, 0))
     tiempo_servicio_min: int = Field(default=30) 
 
+    # Convertir horas "HH:MM" una sola vez, al validar el modelo
+    @field_validator("ventana_inicio", "ventana_fin", mode="before")
+    @classmethod
+    def _parse_time(cls, v):
+        return time.fromisoformat(v) if isinstance(v, str) else v
+
 # -----------------------------------------------------------------
 # Modelos de Tabla (CON DUEÑO)
 # -----------------------------------------------------------------
@@ -45,12 +53,16 @@ class Ruta(RutaBase, table=True):
     id: Optional[int] = Field(default=None, primary_key=True)
     
     # ¡NUEVO! Dueño de la ruta
-    user_id: Optional[int] = Field(default=None, foreign_key="user.id")
+    user_id: Optional[int] = Field(default=None, foreign_key="user.id", index=True)
     owner: Optional[User] = Relationship(back_populates="rutas")
 
     paradas: List["Parada"] = Relationship(back_populates="rutas", link_model=RutaParada)
 
 class Parada(ParadaBase, table=True):
+    # Índice compuesto para los filtros "user_id = ? AND id IN (...)"
+    # (también sirve para buscar solo por user_id)
+    __table_args__ = (Index("ix_parada_user_id_id", "user_id", "id"),)
+
     id: Optional[int] = Field(default=None, primary_key=True)
     
     # ¡NUEVO! Dueño de la parada
@@ -65,6 +77,10 @@ class Parada(ParadaBase, table=True):
 class RutaCreate(RutaBase):
     parada_ids: List[int]
 
+# Cuerpo de POST /paradas/: al no ser tabla, Pydantic sí corre los validadores
+class ParadaCreate(ParadaBase):
+    pass
+
 class ParadaRead(ParadaBase):
     id: int
         
@@ -1,14 +1,29 @@
 # solver.py
+import io
+import os
+import logging
 import math
+import asyncio
+import atexit
+import hashlib
+from collections import deque
+from functools import lru_cache
+from time import monotonic
 import httpx
+import diskcache
+import numpy as np
+import orjson
+from tenacity import retry, retry_if_exception, stop_after_attempt, wait_exponential
 from ortools.constraint_solver import routing_enums_pb2
 from ortools.constraint_solver import pywrapcp
-from typing import List, Dict
+from ortools.util import optional_boolean_pb2
+from typing import List, Dict, NamedTuple, Tuple
 from datetime import time, timedelta
 
-from models import Parada
 from config import MAPBOX_ACCESS_TOKEN
 
+logger = logging.getLogger(__name__)
+
 # -----------------------------------------------------------------
 # ¡¡ESTA ES LA CLASE QUE FALTABA!!
 # -----------------------------------------------------------------
@@ -17,115 +32,336 @@ class NoSolutionError(Exception):
     pass
 # -----------------------------------------------------------------
 
-def get_real_time_matrix(paradas: List[Parada]) -> List[List[int]]:
+class ParadaSolver(NamedTuple):
     """
-    *** FUNCIÓN REAL ***
-    Llama a la API Matrix de Mapbox...
+    Datos de una parada que necesita el solver. Una tupla simple es mucho más
+    barata de leer que un objeto ORM (sin descriptores de SQLAlchemy).
+    Los campos se llaman igual que en Parada.
     """
-    print("Llamando a la API Matrix de Mapbox...")
+    id: int
+    nombre: str
+    lat: float
+    lng: float
+    ventana_inicio: time
+    ventana_fin: time
+    tiempo_servicio_min: int
+
+MAPBOX_PROFILE = "mapbox/driving-traffic"
+MAPBOX_MATRIX_URL = f"https://api.mapbox.com/directions-matrix/v1/{MAPBOX_PROFILE}/"
+# Coordenadas por petición a la API Matrix: 10 con driving-traffic,
+# 25 con los demás perfiles
+MAPBOX_MAX_COORDS = 10 if MAPBOX_PROFILE == "mapbox/driving-traffic" else 25
+# Para más paradas se pide la matriz por bloques: cada petición lleva un
+# bloque de orígenes + uno de destinos, así que cada bloque es la mitad
+MAPBOX_TILE = MAPBOX_MAX_COORDS // 2
+# Velocidad (km/h) con la que Mapbox estima en línea recta los pares sin ruta
+MAPBOX_FALLBACK_SPEED = 60
+# Peticiones simultáneas a Mapbox
+MAPBOX_CONCURRENCY = 10
+# Límite de Mapbox: 60 peticiones por minuto. Por bloques, N paradas son
+# ceil(N / MAPBOX_TILE)² peticiones: hasta 35 paradas (49 peticiones con
+# driving-traffic) caben en un minuto; con más, las que sobran esperan
+MAPBOX_RATE_LIMIT = 60
+MAPBOX_RATE_WINDOW = 60.0
+
+_MAPBOX_LIMITS = httpx.Limits(max_connections=100, max_keepalive_connections=20)
+# Respuestas comprimidas: la matriz en JSON crece con N² (httpx descomprime)
+_MAPBOX_HEADERS = {"Accept-Encoding": "gzip, br"}
+
+# Cliente HTTP compartido: reutiliza la conexión TLS con Mapbox entre
+# llamadas en vez de hacer un handshake nuevo por cada solve_vrp.
+# Es asíncrono: mientras llega la matriz se va armando el modelo.
+_MAPBOX_CLIENT = httpx.AsyncClient(
+    http2=True,
+    timeout=20.0,
+    limits=_MAPBOX_LIMITS,
+    headers=_MAPBOX_HEADERS,
+)
+
+async def close_mapbox_client():
+    """Cierra el cliente HTTP de Mapbox (llamar al apagar el servidor)."""
+    await _MAPBOX_CLIENT.aclose()
+
+# Caché en disco de matrices ya descargadas, compartida entre procesos
+# (workers). Expira en una hora porque los tiempos dependen del tráfico.
+MATRIX_DISK_CACHE_DIR = os.path.expanduser("~/.cache/mapbox_matrix")
+MATRIX_DISK_CACHE_TTL = 3600
+_MATRIX_DISK_CACHE = diskcache.Cache(MATRIX_DISK_CACHE_DIR)
+atexit.register(_MATRIX_DISK_CACHE.close)
+
+Coords = Tuple[Tuple[float, float], ...]  # (lng, lat) por parada, en orden
+
+def _coordinates_str(coords: Coords) -> str:
+    # 6 decimales (~11 cm) es la precisión que usa Mapbox; URLs más cortas
+    buf = io.StringIO()
+    first = True
+    for lng, lat in coords:
+        if not first:
+            buf.write(";")
+        buf.write(f"{lng:.6f},{lat:.6f}")
+        first = False
+    return buf.getvalue()
+
+def _matrix_cache_key(coords: Coords) -> str:
+    return hashlib.blake2b(repr((MAPBOX_PROFILE, coords)).encode()).hexdigest()
+
+def _read_durations(response: httpx.Response) -> List[List[float]]:
+    response.raise_for_status() 
+    data = orjson.loads(response.content)
     
-    coordinates_str = ";".join([f"{p.lng},{p.lat}" for p in paradas])
+    if data['code'] != 'Ok':
+        raise Exception(f"Mapbox API no devolvió 'Ok': {data.get('message', '')}")
     
-    url = f"https://api.mapbox.com/directions-matrix/v1/mapbox/driving-traffic/{coordinates_str}"
+    return data['durations']
+
+# Tiempo para pares sin ruta posible: mucho más que el horizonte del día,
+# así OR-Tools nunca usa ese arco pero el modelo sigue siendo válido
+UNREACHABLE_SECONDS = 10**8
+
+# Errores pasajeros de Mapbox (límite de peticiones, CloudFront caído)
+MAPBOX_RETRY_STATUS = (429, 502, 503, 504)
+
+def _is_transient_mapbox_error(e: BaseException) -> bool:
+    return isinstance(e, httpx.HTTPStatusError) and e.response.status_code in MAPBOX_RETRY_STATUS
+
+# Horas de envío de las últimas peticiones (ventana deslizante). El límite
+# se cuenta por proceso: con varios workers cada uno lleva su propia cuenta
+_mapbox_envios: deque = deque()
+_mapbox_envios_lock = asyncio.Lock()
+
+async def _esperar_turno_mapbox():
+    """Espera hasta que enviar otra petición no pase de MAPBOX_RATE_LIMIT por minuto."""
+    async with _mapbox_envios_lock:
+        ahora = monotonic()
+        while _mapbox_envios and ahora - _mapbox_envios[0] >= MAPBOX_RATE_WINDOW:
+            _mapbox_envios.popleft()
+        if len(_mapbox_envios) >= MAPBOX_RATE_LIMIT:
+            await asyncio.sleep(MAPBOX_RATE_WINDOW - (ahora - _mapbox_envios.popleft()))
+        _mapbox_envios.append(monotonic())
+
+@retry(
+    wait=wait_exponential(multiplier=0.5, max=8),
+    stop=stop_after_attempt(4),
+    retry=retry_if_exception(_is_transient_mapbox_error),
+    reraise=True,
+)
+async def _get_durations(url: str, url_params: dict) -> List[List[float]]:
+    """GET a la API Matrix, reintentando con backoff exponencial si es un error pasajero."""
+    await _esperar_turno_mapbox()
+    response = await _MAPBOX_CLIENT.get(url, params=url_params)
+    return _read_durations(response)
+
+def _to_int_matrix(matrix_float: List[List[float]]) -> np.ndarray:
+    """
+    Segundos float -> int32 (truncando, como int()), en una sola pasada en C.
+    Los null de Mapbox (pares sin ruta) llegan como NaN y pasan a
+    UNREACHABLE_SECONDS.
+    """
+    arr = np.asarray(matrix_float, dtype=np.float64)
+    return np.nan_to_num(arr, nan=UNREACHABLE_SECONDS).astype(np.int32)
+
+async def _fetch_tiled_matrix(coords: Coords) -> List[List[int]]:
+    """
+    Arma la matriz NxN (N > MAPBOX_MAX_COORDS) pidiendo a Mapbox cada bloque
+    (orígenes x destinos) por separado y en paralelo.
+    """
+    n = len(coords)
+    bloques = [list(range(i, min(i + MAPBOX_TILE, n))) for i in range(0, n, MAPBOX_TILE)]
+    matrix_int = np.zeros((n, n), dtype=np.int32)
+    semaforo = asyncio.Semaphore(MAPBOX_CONCURRENCY)
+
+    async def fetch_bloque(origenes: List[int], destinos: List[int]):
+        url_params = {
+            "annotations": "duration",
+            "fallback_speed": MAPBOX_FALLBACK_SPEED,
+            "access_token": MAPBOX_ACCESS_TOKEN
+        }
+        if origenes is destinos:
+            indices = origenes
+        else:
+            # Solo las coordenadas de los dos bloques; sources/destinations
+            # son posiciones dentro de esta petición
+            indices = origenes + destinos
+            url_params["sources"] = ";".join(str(k) for k in range(len(origenes)))
+            url_params["destinations"] = ";".join(
+                str(len(origenes) + k) for k in range(len(destinos))
+            )
+        url = MAPBOX_MATRIX_URL + _coordinates_str([coords[i] for i in indices])
+
+        async with semaforo:
+            durations = await _get_durations(url, url_params)
+
+        matrix_int[np.ix_(origenes, destinos)] = _to_int_matrix(durations)
+
+    await asyncio.gather(*(
+        fetch_bloque(origenes, destinos) for origenes in bloques for destinos in bloques
+    ))
+
+    return matrix_int.tolist()
+
+async def _fetch_matrix(coords: Coords) -> List[List[int]]:
+    """Descarga la matriz de tiempos de Mapbox (sin caché)."""
+    if len(coords) > MAPBOX_MAX_COORDS:
+        return await _fetch_tiled_matrix(coords)
+
+    url = MAPBOX_MATRIX_URL + _coordinates_str(coords)
     url_params = {
         "annotations": "duration",
+        "fallback_speed": MAPBOX_FALLBACK_SPEED,
         "access_token": MAPBOX_ACCESS_TOKEN
     }
+    matrix_float = await _get_durations(url, url_params)
+    return _to_int_matrix(matrix_float).tolist()
 
-    try:
-        with httpx.Client() as client:
-            response = client.get(url, params=url_params, timeout=20.0)
-            response.raise_for_status() 
-            data = response.json()
-            
-            if data['code'] != 'Ok':
-                raise Exception(f"Mapbox API no devolvió 'Ok': {data.get('message', '')}")
-            
-            matrix_float = data['durations']
-            matrix_int = [[int(t) for t in row] for row in matrix_float]
-            
-            print("Matriz de tiempos reales obtenida.")
+async def get_real_time_matrix(paradas: List[ParadaSolver], force_refresh: bool = False) -> List[List[int]]:
+    """
+    *** FUNCIÓN REAL ***
+    Llama a la API Matrix de Mapbox...
+    Con más de MAPBOX_MAX_COORDS paradas la matriz se pide por bloques (ver _fetch_tiled_matrix).
+    El resultado se guarda en la caché en disco; force_refresh=True la ignora.
+    """
+    coords = tuple((p.lng, p.lat) for p in paradas)
+    if len(set(coords)) <= 1:
+        # Todas las paradas en el mismo punto: no hace falta llamar a Mapbox
+        return [[0] * len(coords) for _ in coords]
+
+    key = _matrix_cache_key(coords)
+    if not force_refresh:
+        matrix_int = _MATRIX_DISK_CACHE.get(key)
+        if matrix_int is not None:
             return matrix_int
+
+    logger.info("Llamando a la API Matrix de Mapbox para %d paradas", len(coords))
+
+    try:
+        matrix_int = await _fetch_matrix(coords)
+        _MATRIX_DISK_CACHE.set(key, matrix_int, expire=MATRIX_DISK_CACHE_TTL)
+        
+        logger.info("Matriz de tiempos reales obtenida.")
+        return matrix_int
             
     except httpx.HTTPStatusError as e:
-        print(f"Error HTTP llamando a Mapbox: {e}")
+        logger.error("Error HTTP llamando a Mapbox: %s", e)
         raise Exception(f"Error de Mapbox (código {e.response.status_code}): No se pudo obtener la matriz de tiempos.")
     except Exception as e:
-        print(f"Error procesando respuesta de Mapbox: {e}")
+        logger.error("Error procesando respuesta de Mapbox: %s", e)
         raise
 
 
+# Las ventanas se repiten mucho entre paradas y entre llamadas (08:00, 18:00...)
+@lru_cache(maxsize=1440)
 def time_to_seconds(t: time) -> int:
     return t.hour * 3600 + t.minute * 60 + t.second
 
 # --- Funciones de ayuda para el itinerario ---
 def seconds_to_time_str(seconds_from_midnight: int) -> str:
-    hours = seconds_from_midnight // 3600
-    minutes = (seconds_from_midnight % 3600) // 60
-    period = "AM"
-    if hours >= 12: period = "PM"
-    if hours == 0: hours = 12
-    if hours > 12: hours -= 12
-    return f"{hours:02d}:{minutes:02d} {period}"
+    hours, rem = divmod(seconds_from_midnight, 3600)
+    return time(hours % 24, rem // 60).strftime("%I:%M %p")
+
+_DURATION_FMT = "{} h {:02d} min".format
 
 def seconds_to_duration_str(total_seconds: int) -> str:
     if total_seconds < 60: return f"{total_seconds} seg"
-    hours = total_seconds // 3600
-    minutes = (total_seconds % 3600) // 60
+    hours, rem = divmod(total_seconds, 3600)
     if hours > 0:
-        return f"{hours} h {minutes:02d} min"
-    else:
-        return f"{minutes} min"
+        return _DURATION_FMT(hours, rem // 60)
+    return f"{rem // 60} min"
+
 
+# Presupuesto de búsqueda de OR-Tools: Guided Local Search solo con más de
+# este número de paradas, y tiempo límite proporcional a N (tope de 5 s)
+GLS_MIN_STOPS = 10
+SEARCH_TIME_PER_STOP_MS = 100
+SEARCH_MAX_TIME_MS = 5000
 
-def solve_vrp(paradas: List[Parada]):
+def nearest_neighbor_route(time_matrix: List[List[int]]) -> List[int]:
     """
-    Resuelve el Problema de Enrutamiento de Vehículos (VRP) con Ventanas de Tiempo.
+    Ruta golosa desde el depósito (nodo 0): siempre ir a la parada no visitada
+    más cercana. Sirve como solución inicial para OR-Tools.
     """
-    
-    print(f"Iniciando solver de OR-Tools para {len(paradas)} paradas.")
-    
-    # ... (Secciones 1, 2, 3, 4, 5 - igual que antes) ...
+    sin_visitar = set(range(1, len(time_matrix)))
+    ruta = [0]
+    while sin_visitar:
+        fila = time_matrix[ruta[-1]]
+        siguiente = min(sin_visitar, key=fila.__getitem__)
+        ruta.append(siguiente)
+        sin_visitar.remove(siguiente)
+    return ruta
+
+
+def _build_model(paradas: List[ParadaSolver]):
+    """
+    Secciones 1 y 3: datos del problema y modelo de OR-Tools. No necesita la
+    matriz de tiempos, así que corre mientras se espera a Mapbox.
+    """
+    logger.info("Iniciando solver de OR-Tools para %d paradas.", len(paradas))
     
     # 1. Crear el modelo de datos
     data = {}
-    data['time_windows'] = []
-    data['service_times'] = []
-    
-    for p in paradas:
-        start_sec = time_to_seconds(p.ventana_inicio)
-        end_sec = time_to_seconds(p.ventana_fin)
-        data['time_windows'].append((start_sec, end_sec))
-        data['service_times'].append(p.tiempo_servicio_min * 60)
-        
+    data['time_windows'] = [
+        (time_to_seconds(p.ventana_inicio), time_to_seconds(p.ventana_fin))
+        for p in paradas
+    ]
+    data['service_times'] = [p.tiempo_servicio_min * 60 for p in paradas]
+
     data['num_vehicles'] = 1
     data['depot'] = 0
 
-    # 2. Crear la Matriz de Tiempos de Viaje
-    try:
-        data['time_matrix'] = get_real_time_matrix(paradas)
-    except Exception as e:
-        raise e
-
     # 3. Configurar el Solver
+    num_nodes = len(paradas)
     manager = pywrapcp.RoutingIndexManager(
-        len(data['time_matrix']), data['num_vehicles'], data['depot']
+        num_nodes, data['num_vehicles'], data['depot']
     )
-    routing = pywrapcp.RoutingModel(manager)
+    model_parameters = pywrapcp.DefaultRoutingModelParameters()
+    # OR-Tools guarda en caché los valores del evaluador de arcos
+    model_parameters.max_callback_cache_size = num_nodes * num_nodes
+    # RoutingModelParameters.reduce_vehicle_cost_model: todos los vehículos
+    # comparten el mismo evaluador de costo, así OR-Tools simplifica el modelo
+    model_parameters.reduce_vehicle_cost_model = True
+    routing = pywrapcp.RoutingModel(manager, model_parameters)
 
-    # 4. Definir el "costo" (tiempo)
-    def time_callback(from_index, to_index):
-        from_node = manager.IndexToNode(from_index)
-        to_node = manager.IndexToNode(to_index)
-        return data['time_matrix'][from_node][to_node] + data['service_times'][from_node]
+    return data, manager, routing
 
-    transit_callback_index = routing.RegisterTransitCallback(time_callback)
+
+def _solve_model(paradas: List[ParadaSolver], data: dict, manager, routing):
+    """Secciones 4 a 7: restricciones, búsqueda (CPU) e itinerario."""
+    # 4. Definir el "costo" (tiempo de viaje + servicio en el origen)
+    # La matriz se registra completa del lado de C++: el solver no vuelve a
+    # llamar a Python por cada arco que evalúa
+    # M[i, j] = viaje[i][j] + servicio[i], calculado en int32 con NumPy;
+    # RegisterTransitMatrix pide listas de listas
+    tm = np.asarray(data['time_matrix'], dtype=np.int32)
+    svc = np.asarray(data['service_times'], dtype=np.int32)[:, None]
+    total = tm + svc
+    total_matrix = total.tolist()
+    transit_callback_index = routing.RegisterTransitMatrix(total_matrix)
     routing.SetArcCostEvaluatorOfAllVehicles(transit_callback_index)
 
     # 5. Añadir restricción de Ventanas de Tiempo
+    # Si el depósito tiene una hora de salida fija (ventana de un solo punto)
+    # se fija su acumulado en cero y se corren todas las ventanas a esa
+    # hora: el dominio de CumulVar(start) se reduce a un valor
+    depot_start, depot_end = data['time_windows'][data['depot']]
+    fix_start = depot_start == depot_end
+    time_offset = depot_start if fix_start else 0
+    if time_offset:
+        if any(fin < time_offset for _, fin in data['time_windows']):
+            raise NoSolutionError("No se encontró una ruta: hay paradas cuya ventana de tiempo cierra antes de la hora de salida.")
+        data['time_windows'] = [
+            (max(0, inicio - time_offset), fin - time_offset)
+            for inicio, fin in data['time_windows']
+        ]
+
+    # Horizonte lo más chico posible (dominios de CumulVar más chicos): la
+    # hora más tardía a la que se puede volver al depósito desde alguna
+    # parada, nunca más de un día. La espera máxima sigue en 15 min: con
+    # menos se perderían rutas que hoy son válidas.
+    ends = np.asarray([fin for _, fin in data['time_windows']], dtype=np.int64)
+    horizon = int(min(86400, (ends + total[:, data['depot']]).max()))
+
     time_dim = 'Time'
     routing.AddDimension(
-        transit_callback_index, 900, 86400, False, time_dim
+        transit_callback_index, 900, horizon, fix_start, time_dim
     )
     time_dimension = routing.GetDimensionOrDie(time_dim)
     
@@ -134,52 +370,162 @@ def solve_vrp(paradas: List[Parada]):
         time_dimension.CumulVar(index).SetRange(time_window[0], time_window[1])
 
     # 6. Configurar búsqueda y resolver
+    # Inserción en paralelo encuentra solución inicial en casos con ventanas
+    # ajustadas donde PATH_CHEAPEST_ARC se atasca. Guided Local Search siempre
+    # corre hasta agotar su tiempo límite, así que solo se usa con muchas
+    # paradas y con un límite que crece con N; con pocas, la búsqueda local
+    # por defecto termina sola en milisegundos
     search_parameters = pywrapcp.DefaultRoutingSearchParameters()
     search_parameters.first_solution_strategy = (
-        routing_enums_pb2.FirstSolutionStrategy.PATH_CHEAPEST_ARC
+        routing_enums_pb2.FirstSolutionStrategy.PARALLEL_CHEAPEST_INSERTION
+    )
+    if len(paradas) > GLS_MIN_STOPS:
+        search_parameters.local_search_metaheuristic = (
+            routing_enums_pb2.LocalSearchMetaheuristic.GUIDED_LOCAL_SEARCH
+        )
+    # Un solo presupuesto para todos los intentos de abajo: cada uno recibe
+    # lo que queda, así la respuesta nunca tarda más que el límite
+    limite_ms = min(SEARCH_MAX_TIME_MS, SEARCH_TIME_PER_STOP_MS * len(paradas))
+    fin_busqueda = monotonic() + limite_ms / 1000
+
+    def restante_ms() -> int:
+        # Al menos 1 ms: una duración 0 no se debe pasar como límite
+        return max(1, int((fin_busqueda - monotonic()) * 1000))
+
+    search_parameters.time_limit.FromMilliseconds(limite_ms)
+    search_parameters.log_search = False
+
+    if data['num_vehicles'] > 1:
+        # Con varios vehículos, usar CP-SAT en paralelo en todos los núcleos
+        search_parameters.use_cp_sat = optional_boolean_pb2.BOOL_TRUE
+        search_parameters.number_of_solutions_to_collect = 1
+        search_parameters.sat_parameters.num_search_workers = os.cpu_count() or 1
+
+    logger.debug("Resolviendo...")
+    # Arrancar la búsqueda desde la ruta del vecino más cercano
+    routing.CloseModelWithParameters(search_parameters)
+    vecino = nearest_neighbor_route(data['time_matrix'])
+    initial_assignment = routing.ReadAssignmentFromRoutes(
+        [[manager.NodeToIndex(nodo) for nodo in vecino[1:]]], True
     )
+    solution = None
+    if initial_assignment is not None:
+        solution = routing.SolveFromAssignmentWithParameters(
+            initial_assignment, search_parameters
+        )
+    if not solution and monotonic() < fin_busqueda:
+        search_parameters.time_limit.FromMilliseconds(restante_ms())
+        solution = routing.SolveWithParameters(search_parameters)
 
-    print("Resolviendo...")
-    solution = routing.SolveWithParameters(search_parameters)
+    if not solution and monotonic() < fin_busqueda:
+        # Segundo intento con la estrategia anterior
+        fallback_parameters = pywrapcp.DefaultRoutingSearchParameters()
+        fallback_parameters.first_solution_strategy = (
+            routing_enums_pb2.FirstSolutionStrategy.PATH_CHEAPEST_ARC
+        )
+        # Siempre con límite de tiempo: sin él, en un caso infactible
+        # PATH_CHEAPEST_ARC busca sin fin y ocupa el hilo indefinidamente
+        fallback_parameters.time_limit.FromMilliseconds(restante_ms())
+        solution = routing.SolveWithParameters(fallback_parameters)
 
     # -----------------------------------------------------------------
     # SECCIÓN 7 (MODIFICADA PARA LANZAR EL ERROR)
     # -----------------------------------------------------------------
     if not solution:
-        print("No se encontró solución.")
+        logger.info("No se encontró solución.")
         # ¡LANZAMOS NUESTRO ERROR PERSONALIZADO!
         raise NoSolutionError("No se encontró una ruta. Es imposible cumplir con todas las ventanas de tiempo. Intenta con menos paradas o revisa sus horarios.")
 
     # (El resto del código es igual que antes)
-    print("Solución encontrada. Construyendo itinerario...")
-    itinerary = []
-    index = routing.Start(0)
-    time_dimension = routing.GetDimensionOrDie('Time')
+    logger.debug("Solución encontrada. Construyendo itinerario...")
+    start_idx = routing.Start(0)
+    index = start_idx
     last_departure_time_seconds = 0
 
-    while not routing.IsEnd(index):
-        nodo_idx = manager.IndexToNode(index)
-        parada = paradas[nodo_idx]
-        
-        arrival_time_seconds = solution.Value(time_dimension.CumulVar(index))
-        service_time_seconds = data['service_times'][nodo_idx]
-        departure_time_seconds = arrival_time_seconds + service_time_seconds
-        travel_time_seconds = arrival_time_seconds - last_departure_time_seconds
+    # Métodos en variables locales: el bucle los llama en cada parada
+    sv = solution.Value
+    cv = time_dimension.CumulVar
+    nv = routing.NextVar
+    itn = manager.IndexToNode
+    is_end = routing.IsEnd
+    service_times = data['service_times']
+
+    # (nodo, llegada, salida, viaje) por parada; los dicts se arman al final
+    visitas = [None] * len(paradas)
+    pos = 0
+    while not is_end(index):
+        nodo_idx = itn(index)
+        arrival_time_seconds = sv(cv(index)) + time_offset
+        departure_time_seconds = arrival_time_seconds + service_times[nodo_idx]
+        visitas[pos] = (
+            nodo_idx, arrival_time_seconds, departure_time_seconds,
+            arrival_time_seconds - last_departure_time_seconds
+        )
         last_departure_time_seconds = departure_time_seconds
+        pos += 1
+        index = sv(nv(index))
 
-        itinerary.append({
-            "parada": parada,
-            "arrival_time": seconds_to_time_str(arrival_time_seconds),
-            "departure_time": seconds_to_time_str(departure_time_seconds),
-            "travel_time_to_stop": seconds_to_duration_str(travel_time_seconds)
-        })
-        index = solution.Value(routing.NextVar(index))
+    itinerary = [
+        {
+            "parada": paradas[nodo_idx],
+            "arrival_time": seconds_to_time_str(arrival),
+            "departure_time": seconds_to_time_str(departure),
+            "travel_time_to_stop": seconds_to_duration_str(travel)
+        }
+        for nodo_idx, arrival, departure, travel in visitas[:pos]
+    ]
 
-    total_duration_seconds = solution.Value(time_dimension.CumulVar(index))
-    total_duration_seconds -= solution.Value(time_dimension.CumulVar(routing.Start(0)))
+    end_cum = sv(cv(index))
+    total_duration_seconds = end_cum - sv(cv(start_idx))
     
     return {
         "stops": itinerary,
         "total_duration_seconds": total_duration_seconds,
         "total_duration_str": seconds_to_duration_str(total_duration_seconds)
-    }
\ No newline at end of file
+    }
+
+async def solve_vrp(
+    paradas: List[ParadaSolver],
+    distance_matrix: List[List[int]] = None,
+    fetch_matrix=None,
+):
+    """
+    Resuelve el Problema de Enrutamiento de Vehículos (VRP) con Ventanas de Tiempo.
+    Si se pasa distance_matrix (tiempos en segundos, en el orden de paradas)
+    no se llama a Mapbox. Si no, la matriz se obtiene con fetch_matrix
+    (corrutina que recibe las paradas; por defecto get_real_time_matrix).
+    La obtención de la matriz y el armado del modelo se hacen a la vez, y
+    todo el trabajo de OR-Tools corre en hilos para no bloquear el event loop.
+    """
+    
+    if len(paradas) <= 1:
+        # Solo el punto de inicio: no hay nada que optimizar ni que pedir a Mapbox
+        itinerary = []
+        for p in paradas:
+            arrival_time_seconds = time_to_seconds(p.ventana_inicio)
+            departure_time_seconds = arrival_time_seconds + p.tiempo_servicio_min * 60
+            itinerary.append({
+                "parada": p,
+                "arrival_time": seconds_to_time_str(arrival_time_seconds),
+                "departure_time": seconds_to_time_str(departure_time_seconds),
+                "travel_time_to_stop": seconds_to_duration_str(arrival_time_seconds)
+            })
+        return {
+            "stops": itinerary,
+            "total_duration_seconds": 0,
+            "total_duration_str": seconds_to_duration_str(0)
+        }
+
+    # 2. Crear la Matriz de Tiempos de Viaje (en paralelo con el modelo)
+    if distance_matrix is not None:
+        data, manager, routing = await asyncio.to_thread(_build_model, paradas)
+        data['time_matrix'] = distance_matrix
+    else:
+        fetch_matrix = fetch_matrix or get_real_time_matrix
+        time_matrix, (data, manager, routing) = await asyncio.gather(
+            fetch_matrix(paradas),
+            asyncio.to_thread(_build_model, paradas),
+        )
+        data['time_matrix'] = time_matrix
+
+    return await asyncio.to_thread(_solve_model, paradas, data, manager, routing)